@@ -133,7 +133,8 @@ def main(args):
             t = 0
         log.debug("Final rotation: %s" % str(r).replace("\n", "\n" + " " * 16))
         log.debug("Final translation: %s (%f px)" % (str(t), np.linalg.norm(t)))
-        data = vop.resample_volume(data, r=r, t=t, ori=None, order=args.spline_order, invert=args.invert)
+        data = vop.resample_volume(data, r=r, t=t, ori=None, order=args.spline_order, invert=args.invert,
+                                   gpu=args.gpu)
 
     if args.target is not None:
         try:
@@ -149,7 +150,8 @@ def main(args):
         log.info("Euler angles are %s deg and shift is %f px" % (np.rad2deg(rot2euler(r)), t))
         log.debug("Final rotation: %s" % str(r).replace("\n", "\n" + " " * 16))
         log.debug("Final translation: %s (%f px)" % (str(t), np.linalg.norm(t)))
-        data = vop.resample_volume(data, r=r, t=args.target, ori=ori, order=args.spline_order, invert=args.invert)
+        data = vop.resample_volume(data, r=r, t=args.target, ori=ori, order=args.spline_order, invert=args.invert,
+                                   gpu=args.gpu)
 
     if args.euler is not None:
         try:
@@ -179,7 +181,8 @@ def main(args):
         final *= final_mask
 
     if args.scale != 1 or args.boxsize != box[0]:
-        final = vop.resample_volume(final, scale=args.scale, output_shape=args.boxsize, order=args.spline_order)
+        final = vop.resample_volume(final, scale=args.scale, output_shape=args.boxsize, order=args.spline_order,
+                                     gpu=args.gpu)
 
     write(args.output, final, psz=args.apix_out)
     return 0
@@ -213,5 +216,6 @@ if __name__ == "__main__":
     parser.add_argument("--spline-order",
                         help="Order of spline interpolation (0 for nearest, 1 for trilinear, default is cubic)",
                         type=int, default=3, choices=np.arange(6))
+    parser.add_argument("--gpu", help="Resample on the GPU (requires CuPy)", action="store_true")
     parser.add_argument("--loglevel", "-l", type=str, default="WARNING", help="Logging level and debug output")
     sys.exit(main(parser.parse_args()))
@@ -43,7 +43,7 @@ def main(args):
     if args.map is not None:
         if args.map.endswith(".npy"):
             log.info("Reading precomputed 3D FFT of volume")
-            f3d = np.load(args.map)
+            f3d = np.load(args.map, mmap_mode="r")
             log.info("Finished reading 3D FFT of volume")
             if args.size is None:
                 args.size = (f3d.shape[0] - 3) // args.pfac
@@ -125,8 +125,7 @@ def project(f3d, p, s, sx, sy, a, pfac=2, apply_ctf=False, size=None, flip_phase
     orient = util.euler2rot(np.deg2rad(p[star.Relion.ANGLEROT]),
                             np.deg2rad(p[star.Relion.ANGLETILT]),
                             np.deg2rad(p[star.Relion.ANGLEPSI]))
-    pshift = np.exp(-2 * np.pi * 1j * (-p[star.Relion.ORIGINX] * sx +
-                                       -p[star.Relion.ORIGINY] * sy))
+    pshift = vop.phase_shift(sx, sy, p[star.Relion.ORIGINX], p[star.Relion.ORIGINY])
     f2d = vop.interpolate_slice_numba(f3d, orient, pfac=pfac, size=size)
     f2d *= pshift
     if apply_ctf or flip_phase:
@@ -42,6 +42,13 @@ from pyfftw.builders import rfft2
 from pyfftw.builders import irfft2
 
 
+FIELDS = [star.UCSF.IMAGE_INDEX, star.UCSF.IMAGE_ORIGINAL_PATH, star.UCSF.IMAGE_ORIGINAL_INDEX,
+          star.Relion.DEFOCUSU, star.Relion.DEFOCUSV, star.Relion.DEFOCUSANGLE, star.Relion.PHASESHIFT,
+          star.Relion.VOLTAGE, star.Relion.AC, star.Relion.CS,
+          star.Relion.ANGLEROT, star.Relion.ANGLETILT, star.Relion.ANGLEPSI,
+          star.Relion.ORIGINX, star.Relion.ORIGINY]
+
+
 def main(args):
     """
     Projection subtraction program entry point.
@@ -84,7 +91,7 @@ def main(args):
         log.info("Finished 3D FFT of volume")
     else:
         log.info("Loading 3D FFT from %s" % args.submap_ft)
-        submap_ft = np.load(args.submap_ft)
+        submap_ft = np.load(args.submap_ft, mmap_mode="r")
         log.info("Loaded 3D FFT from %s" % args.submap_ft)
 
     sz = (submap_ft.shape[0] - 3) // args.pfac
@@ -100,7 +107,6 @@ def main(args):
     r = np.round(r).astype(np.int64)
     r[r > sz // 2] = sz // 2 + 1
     nr = np.max(r) + 1
-    a = np.arctan2(sy, sx)
 
     if args.refmap is not None:
         coefs_method = 1
@@ -109,7 +115,7 @@ def main(args):
             refmap_ft = vop.vol_ft(refmap, pfac=args.pfac, threads=min(args.threads, cpu_count()))
         else:
             log.info("Loading 3D FFT from %s" % args.refmap_ft)
-            refmap_ft = np.load(args.refmap_ft)
+            refmap_ft = np.load(args.refmap_ft, mmap_mode="r")
             log.info("Loaded 3D FFT from %s" % args.refmap_ft)
     else:
         coefs_method = 0
@@ -125,12 +131,10 @@ def main(args):
     qsize = args.io_queue_length
     fftthreads = args.fft_threads
 
-    def init():
-        global tls
-        tls = threading.local()
-
     log.info("Instantiating thread pool with %d workers" % args.threads)
-    pool = Pool(processes=args.threads, initializer=init)
+    pool = Pool(processes=args.threads, initializer=init,
+                initargs=(submap_ft, refmap_ft, sx, sy, apix, coefs_method, r, nr,
+                          fftthreads, args.crop, args.pfac))
     threads = []
     
     log.info("Performing projection subtraction")
@@ -142,12 +146,11 @@ def main(args):
             log.debug("Create producer for %s" % fname)
             prod = threading.Thread(
                 target=producer,
-                args=(pool, queue, submap_ft, refmap_ft, fname, particles,
-                      sx, sy, s, a, apix, coefs_method, r, nr, fftthreads, args.crop, args.pfac))
+                args=(pool, queue, fname, particles, args.io_chunk_size))
             log.debug("Create consumer for %s" % fname)
             cons = threading.Thread(
                 target=consumer,
-                args=(queue, fname, apix, iothreads))
+                args=(queue, fname, apix, iothreads, args.io_buffer))
             threads.append((prod, cons))
             iothreads.acquire()
             log.debug("iotheads at %d" % iothreads._Semaphore__value)
@@ -180,54 +183,95 @@ def main(args):
     return 0
 
 
-def subtract_outer(p1r, ptcl, submap_ft, refmap_ft, sx, sy, s, a, apix, coefs_method, r, nr, **kwargs):
+def init(submap_ft, refmap_ft, sx, sy, apix, coefs_method, r, nr, fftthreads=1, crop=None, pfac=2):
+    """
+    Pool initializer. Volumes and frequency grids are shared by every task, so they are
+    stored once per worker rather than being passed with each particle.
+    """
+    global tls, ctx
+    tls = threading.local()
+    ctx = {"submap_ft": submap_ft, "refmap_ft": refmap_ft, "sx": sx, "sy": sy, "apix": apix,
+           "coefs_method": coefs_method, "r": r, "nr": nr, "fftthreads": fftthreads, "crop": crop,
+           "pfac": pfac}
+
+
+def subtract_chunk(chunk):
+    p1r, meta = chunk
+    return subtract_outer(p1r, meta, **ctx)
+
+
+def subtract_outer(p1r, meta, submap_ft, refmap_ft, sx, sy, apix, coefs_method, r, nr, **kwargs):
+    """
+    Subtract projections from a chunk of particles. Fourier slices and CTFs are computed per particle,
+    while the forward and inverse FFTs are each done once for the whole chunk.
+    :param p1r: Stack of particle images.
+    :param meta: Dictionary of particle metadata arrays, with one entry per image in the stack.
+    """
     log = logging.getLogger('root')
-    log.debug("%d@%s Exp %f +/- %f" % (ptcl[star.UCSF.IMAGE_ORIGINAL_INDEX], ptcl[star.UCSF.IMAGE_ORIGINAL_PATH], np.mean(p1r), np.std(p1r)))
-    ft = getattr(tls, 'ft', None)
+    for k in range(p1r.shape[0]):
+        log.debug("%d@%s Exp %f +/- %f" % (meta[star.UCSF.IMAGE_ORIGINAL_INDEX][k], meta[star.UCSF.IMAGE_ORIGINAL_PATH][k], np.mean(p1r[k]), np.std(p1r[k])))
+    fts = getattr(tls, 'fts', None)
+    if fts is None:
+        fts = {}
+        tls.fts = fts
+    ft = fts.get(p1r.shape, None)
     if ft is None:
-        ft = rfft2(fftshift(p1r.copy()), threads=kwargs["fftthreads"],
+        ft = rfft2(fftshift(p1r.copy(), axes=(-2, -1)), axes=(-2, -1), threads=kwargs["fftthreads"],
                    planner_effort="FFTW_ESTIMATE",
                    overwrite_input=False,
                    auto_align_input=True,
                    auto_contiguous=True)
-        tls.ft = ft
+        fts[p1r.shape] = ft
     if coefs_method >= 1:
         p1 = ft(p1r.copy(), np.zeros(ft.output_shape, dtype=ft.output_dtype)).copy()
     else:
         p1 = np.empty(ft.output_shape, ft.output_dtype)
 
-    p1s = subtract(p1, submap_ft, refmap_ft, sx, sy, s, a, apix,
-                   ptcl[star.Relion.DEFOCUSU], ptcl[star.Relion.DEFOCUSV], ptcl[star.Relion.DEFOCUSANGLE],
-                   ptcl[star.Relion.PHASESHIFT], ptcl[star.Relion.VOLTAGE], ptcl[star.Relion.AC], ptcl[star.Relion.CS],
-                   ptcl[star.Relion.ANGLEROT], ptcl[star.Relion.ANGLETILT], ptcl[star.Relion.ANGLEPSI],
-                   ptcl[star.Relion.ORIGINX], ptcl[star.Relion.ORIGINY], coefs_method, r, nr, kwargs["pfac"])
-
-    ift = getattr(tls, 'ift', None)
+    p1s = None
+    for k in range(p1r.shape[0]):
+        # Terms which don't depend on defocus are cached by microscope parameters.
+        base = ctf.ctf_base(p1r.shape[-1], apix, meta[star.Relion.VOLTAGE][k], meta[star.Relion.CS][k], lp=2 * apix)
+        c = ctf.eval_ctf_base(*base, def1=meta[star.Relion.DEFOCUSU][k], def2=meta[star.Relion.DEFOCUSV][k],
+                              angast=meta[star.Relion.DEFOCUSANGLE][k], phase=meta[star.Relion.PHASESHIFT][k],
+                              ac=meta[star.Relion.AC][k])
+        p1sk = subtract(p1[k], submap_ft, refmap_ft, c, sx, sy,
+                        meta[star.Relion.ANGLEROT][k], meta[star.Relion.ANGLETILT][k], meta[star.Relion.ANGLEPSI][k],
+                        meta[star.Relion.ORIGINX][k], meta[star.Relion.ORIGINY][k], coefs_method, r, nr, kwargs["pfac"])
+        if p1s is None:
+            p1s = np.empty((p1r.shape[0],) + p1sk.shape, dtype=p1sk.dtype)
+        p1s[k] = p1sk
+
+    ifts = getattr(tls, 'ifts', None)
+    if ifts is None:
+        ifts = {}
+        tls.ifts = ifts
+    ift = ifts.get(p1s.shape, None)
     if ift is None:
-        ift = irfft2(p1s.copy(), threads=kwargs["fftthreads"],
+        ift = irfft2(p1s.copy(), axes=(-2, -1), threads=kwargs["fftthreads"],
                      planner_effort="FFTW_ESTIMATE",
                      auto_align_input=True,
                      auto_contiguous=True)
-        tls.ift = ift
-    p1sr = fftshift(ift(p1s.copy(), np.zeros(ift.output_shape, dtype=ift.output_dtype)).copy())
-    log.debug("%d@%s Exp %f +/- %f, Sub %f +/- %f" % (ptcl[star.UCSF.IMAGE_ORIGINAL_INDEX], ptcl[star.UCSF.IMAGE_ORIGINAL_PATH], np.mean(p1r), np.std(p1r), np.mean(p1sr), np.std(p1sr)))
-    new_image = p1r - p1sr
-    if kwargs["crop"] is not None:
-        orihalf = new_image.shape[0] // 2
-        newhalf = kwargs["crop"] // 2
-        x = orihalf - np.int(np.round(ptcl[star.Relion.ORIGINX]))
-        y = orihalf - np.int(np.round(ptcl[star.Relion.ORIGINY]))
-        new_image = new_image[y - newhalf:y + newhalf, x - newhalf:x + newhalf]
-    return new_image
+        ifts[p1s.shape] = ift
+    p1sr = fftshift(ift(p1s.copy(), np.zeros(ift.output_shape, dtype=ift.output_dtype)).copy(), axes=(-2, -1))
+    new_images = []
+    for k in range(p1r.shape[0]):
+        log.debug("%d@%s Exp %f +/- %f, Sub %f +/- %f" % (meta[star.UCSF.IMAGE_ORIGINAL_INDEX][k], meta[star.UCSF.IMAGE_ORIGINAL_PATH][k], np.mean(p1r[k]), np.std(p1r[k]), np.mean(p1sr[k]), np.std(p1sr[k])))
+        new_image = p1r[k] - p1sr[k]
+        if kwargs["crop"] is not None:
+            orihalf = new_image.shape[0] // 2
+            newhalf = kwargs["crop"] // 2
+            x = orihalf - int(np.round(meta[star.Relion.ORIGINX][k]))
+            y = orihalf - int(np.round(meta[star.Relion.ORIGINY][k]))
+            new_image = new_image[y - newhalf:y + newhalf, x - newhalf:x + newhalf]
+        new_images.append(new_image)
+    return new_images
 
 
 @numba.jit(cache=False, nopython=True, nogil=True)
-def subtract(p1, submap_ft, refmap_ft,
-             sx, sy, s, a, apix, def1, def2, angast, phase, kv, ac, cs,
+def subtract(p1, submap_ft, refmap_ft, c, sx, sy,
              az, el, sk, xshift, yshift, coefs_method, r, nr, pfac):
-    c = ctf.eval_ctf(s / apix, a, def1, def2, angast, phase, kv, ac, cs, bf=0, lp=2 * apix)
     orient = euler2rot(np.deg2rad(az), np.deg2rad(el), np.deg2rad(sk))
-    pshift = np.exp(-2 * np.pi * 1j * (-xshift * sx + -yshift * sy))
+    pshift = vop.phase_shift(sx, sy, xshift, yshift)
     p2 = vop.interpolate_slice_numba(submap_ft, orient, pfac=pfac)
     p2 *= pshift
     if coefs_method < 1:
@@ -243,31 +287,40 @@ def subtract(p1, submap_ft, refmap_ft,
     return p1s
 
 
-def producer(pool, queue, submap_ft, refmap_ft, fname, particles,
-             sx, sy, s, a, apix, coefs_method, r, nr, fftthreads=1, crop=None, pfac=2):
+def read_chunks(zreader, particles, chunksize=1):
+    """
+    Read particle images in chunks, along with the metadata needed for subtraction as arrays.
+    Columns are extracted once per stack rather than building a Series for every particle.
+    """
+    log = logging.getLogger('root')
+    meta = {k: particles[k].values for k in FIELDS}
+    for i in range(0, particles.shape[0], chunksize):
+        chunk = {k: v[i:i + chunksize] for k, v in meta.items()}
+        p1r = []
+        for idx, path in zip(chunk[star.UCSF.IMAGE_ORIGINAL_INDEX], chunk[star.UCSF.IMAGE_ORIGINAL_PATH]):
+            log.debug("Produce %d@%s" % (idx, path))
+            p1r.append(zreader.read(idx))
+        yield np.array(p1r), chunk
+
+
+def producer(pool, queue, fname, particles, chunksize=1):
     log = logging.getLogger('root')
     log.debug("Producing %s" % fname)
     zreader = mrc.ZSliceReader(particles[star.UCSF.IMAGE_ORIGINAL_PATH].iloc[0])
-    for i, ptcl in particles.iterrows():
-        log.debug("Produce %d@%s" % (ptcl[star.UCSF.IMAGE_ORIGINAL_INDEX], ptcl[star.UCSF.IMAGE_ORIGINAL_PATH]))
-        # p1r = mrc.read_imgs(stack[i], idx[i] - 1, compat="relion")
-        p1r = zreader.read(ptcl[star.UCSF.IMAGE_ORIGINAL_INDEX])
+    for chunk in read_chunks(zreader, particles, chunksize):
         log.debug("Apply")
-        ri = pool.apply_async(
-            subtract_outer,
-            (p1r, ptcl, submap_ft, refmap_ft, sx, sy, s, a, apix, coefs_method, r, nr),
-            {"fftthreads": fftthreads, "crop": crop, "pfac": pfac})
+        ri = pool.apply_async(subtract_chunk, (chunk,))
         log.debug("Put")
-        queue.put((ptcl[star.UCSF.IMAGE_INDEX], ri), block=True)
-        log.debug("Queue for %s is size %d" % (ptcl[star.UCSF.IMAGE_ORIGINAL_PATH], queue.qsize()))
+        queue.put((chunk[1][star.UCSF.IMAGE_INDEX][0], ri), block=True)
+        log.debug("Queue for %s is size %d" % (fname, queue.qsize()))
     zreader.close()
     log.debug("Put poison pill")
     queue.put((-1, None), block=True)
 
 
-def consumer(queue, stack, apix=1.0, iothreads=None):
+def consumer(queue, stack, apix=1.0, iothreads=None, buffer=1):
     log = logging.getLogger('root')
-    with mrc.ZSliceWriter(stack, psz=apix) as zwriter:
+    with mrc.ZSliceWriter(stack, psz=apix, buffer=buffer) as zwriter:
         while True:
             log.debug("Get")
             i, ri = queue.get(block=True)
@@ -275,12 +328,13 @@ def consumer(queue, stack, apix=1.0, iothreads=None):
                       (i, stack, queue.qsize()))
             if i == -1:
                 break
-            new_image = ri.get()
-            log.debug("Result for %d was shape (%d,%d)" %
-                      (i, new_image.shape[0], new_image.shape[1]))
-            zwriter.write(new_image)
+            new_images = ri.get()
+            for new_image in new_images:
+                log.debug("Result for %d was shape (%d,%d)" %
+                          (i, new_image.shape[0], new_image.shape[1]))
+                zwriter.write(new_image)
             queue.task_done()
-            log.debug("Wrote %d to %d@%s" % (i, zwriter.i, stack))
+            log.debug("Wrote %d images from %d to %d@%s" % (len(new_images), i, zwriter.i, stack))
     if iothreads is not None:
         iothreads.release()
 
@@ -303,6 +357,11 @@ if __name__ == "__main__":
     parser.add_argument("--threads", "-j", type=int, default=None, help="Number of simultaneous threads")
     parser.add_argument("--io-thread-pairs", type=int, default=1)
     parser.add_argument("--io-queue-length", type=int, default=1000)
+    parser.add_argument("--io-chunk-size", help="Number of particles read ahead, dispatched and Fourier transformed together per task",
+                        type=int, default=1)
+    parser.add_argument("--io-buffer", help="Number of subtracted images buffered between writes to each stack "
+                                             "(use 1 on network file systems where large writes are slower)",
+                        type=int, default=64)
     parser.add_argument("--fft-threads", type=int, default=1)
     parser.add_argument("--pfac", help="Padding factor for 3D FFT", type=int, default=2)
     parser.add_argument("--loglevel", "-l", type=str, default="WARNING", help="Logging level and debug output")
@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numba
 import numpy as np
+from functools import lru_cache
 
 
 def ctf_freqs(shape, d=1.0, full=True):
@@ -28,10 +29,10 @@ def ctf_freqs(shape, d=1.0, full=True):
     :param full: When false, return only unique Fourier half-space for real data. 
     """
     if full:
-        xfrq = np.fft.fftfreqs(shape[1])
+        xfrq = np.fft.fftfreq(shape[1])
     else:
-        xfrq = np.fft.rfftfreqs(shape[1])
-    x, y = np.meshgrid(xfrq, np.fft.fftfreqs(shape[0]))
+        xfrq = np.fft.rfftfreq(shape[1])
+    x, y = np.meshgrid(xfrq, np.fft.fftfreq(shape[0]))
     rho = np.sqrt(x**2 + y**2)
     a = np.arctan2(y, x)
     s = rho * d
@@ -76,6 +77,56 @@ def eval_ctf(s, a, def1, def2, angast=0, phase=0, kv=300, ac=0.1, cs=2.0, bf=0,
     return ctf
 
 
+@lru_cache(maxsize=8)
+def ctf_base(n, apix, kv=300, cs=2.0, lp=0):
+    """
+    Defocus-independent terms of the CTF phase on the rfft2 half-spectrum grid, for use with
+    eval_ctf_base. Cached by microscope parameters; returned arrays are read-only.
+    :param n: Image size in pixels.
+    :param apix: Pixel size (Å).
+    :param kv:  Microscope acceleration potential (kV).
+    :param cs:  Spherical aberration (mm).
+    :param lp:  Hard low-pass filter (Å), should usually be Nyquist.
+    :return: s^2, s^2 * cos(2a), s^2 * sin(2a), spherical aberration phase, and defocus phase constant.
+    """
+    s, a = ctf_freqs((n, n), d=1. / apix, full=False)
+    kv = kv * 1e3
+    cs = cs * 1e7
+    lamb = 12.2643247 / np.sqrt(kv * (1. + kv * 0.978466e-6))
+    k1 = np.pi / 2. * 2 * lamb
+    k2 = np.pi / 2. * cs * lamb**3
+    if lp != 0:  # Hard low- or high-pass.
+        s *= s <= (1. / lp)
+    s_2 = s**2
+    base = (s_2, s_2 * np.cos(2 * a), s_2 * np.sin(2 * a), k2 * s_2**2)
+    for arr in base:
+        arr.flags.writeable = False
+    return base + (k1,)
+
+
+@numba.jit(cache=True, nopython=True, nogil=True)
+def eval_ctf_base(s_2, s_2c, s_2s, cs_phase, k1, def1, def2, angast=0, phase=0, ac=0.1):
+    """
+    Evaluate a CTF (without envelope) from precomputed terms returned by ctf_base.
+    Only the defocus and phase shift terms are computed, and amplitude contrast is
+    applied as a phase offset so that a single sine is evaluated per frequency.
+    :param def1: 1st prinicipal underfocus distance (Å).
+    :param def2: 2nd principal underfocus distance (Å).
+    :param angast: Angle of astigmatism (deg) from x-axis to azimuth.
+    :param phase: Phase shift (deg).
+    :param ac:  Amplitude contrast in [0, 1.0].
+    """
+    angast = np.deg2rad(angast)
+    def_avg = -(def1 + def2) * 0.5
+    def_dev = -(def1 - def2) * 0.5
+    k5 = np.deg2rad(phase)  # Phase shift.
+    k6 = np.arcsin(ac)  # Amplitude contrast phase.
+    dZs_2 = def_avg * s_2 + def_dev * (np.cos(2 * angast) * s_2c + np.sin(2 * angast) * s_2s)
+    gamma = (k1 * dZs_2) + cs_phase - k5
+    ctf = -np.sin(gamma - k6)
+    return ctf
+
+
 @numba.jit(cache=True, nopython=True, nogil=True)
 def eval_ctf_between(n, apix, def1, def2, lores=0, hires=0, angast=0, phase=0, kv=300, ac=0.1, cs=2.0, bf=0, out=None):
     if out is None:
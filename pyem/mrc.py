@@ -243,7 +243,10 @@ class ZSliceReader:
 
 
 class ZSliceWriter:
-    def __init__(self, fname, shape=None, dtype=np.float32, psz=1.0, mode="w"):
+    def __init__(self, fname, shape=None, dtype=np.float32, psz=1.0, mode="w", buffer=1):
+        """
+        :param buffer: Number of z-slices to accumulate in memory between writes to the file.
+        """
         self.path = fname
         self.shape = None
         self.size = None
@@ -251,6 +254,9 @@ class ZSliceWriter:
         self.dtype = None
         self.f = None
         self.i = 0
+        self.buffer = buffer
+        self.buf = None
+        self.nbuf = 0
         if shape is not None:
             self.set_shape(shape)
         if dtype is not None:
@@ -309,10 +315,28 @@ class ZSliceWriter:
         assert np.can_cast(arr.dtype, self.dtype, casting="same_kind")
         assert arr.size % self.size == 0
         # self.f.seek(HEADER_LEN + self.i * self.dtype.itemsize * arr.size)
-        self.f.write(np.require(arr, dtype=self.dtype).tobytes())
+        if self.buffer > 1:
+            if self.buf is None:
+                self.buf = np.empty((self.buffer,) + self.shape, dtype=self.dtype)
+            for zslice in np.reshape(arr, (-1,) + self.shape):
+                self.buf[self.nbuf] = zslice
+                self.nbuf += 1
+                if self.nbuf == self.buffer:
+                    self.flush()
+        else:
+            self.f.write(np.require(arr, dtype=self.dtype).tobytes())
         self.i += arr.size / self.size
 
+    def flush(self):
+        """
+        Write any buffered z-slices to the underlying File object.
+        """
+        if self.nbuf > 0:
+            self.f.write(self.buf[:self.nbuf].data)
+            self.nbuf = 0
+
     def close(self):
+        self.flush()
         header = mrc_header(shape=(self.shape[1], self.shape[0], self.i),
                             dtype=self.dtype, psz=self.psz)
         self.f.seek(0)
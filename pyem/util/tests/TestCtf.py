@@ -0,0 +1,23 @@
+# Copyright (C) 2018 Daniel Asarnow
+# University of California, San Francisco
+import numpy as np
+import unittest
+from pyem import ctf
+
+
+class TestCtf(unittest.TestCase):
+    def test_eval_ctf_base(self):
+        n, apix, kv, cs = 128, 1.2, 300., 2.7
+        s, a = ctf.ctf_freqs((n, n), d=1. / apix, full=False)
+        base = ctf.ctf_base(n, apix, kv, cs, 2 * apix)
+        for def1, def2, angast, phase, ac in [(15000., 15000., 0., 0., 0.1),
+                                               (18000., 16500., 37.5, 0., 0.07),
+                                               (9000., 11000., -120., 90., 0.1)]:
+            c1 = ctf.eval_ctf(s.copy(), a, def1, def2, angast=angast, phase=phase, kv=kv, ac=ac, cs=cs,
+                              bf=0, lp=2 * apix)
+            c2 = ctf.eval_ctf_base(*base, def1, def2, angast=angast, phase=phase, ac=ac)
+            self.assertTrue(np.allclose(c1, c2, rtol=0, atol=1e-12))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+# Copyright (C) 2018 Daniel Asarnow
+# University of California, San Francisco
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+from pyem import mrc
+
+
+class TestMrc(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_stack(self, imgs, buffer):
+        fname = os.path.join(self.tmpdir, "buffer%d.mrcs" % buffer)
+        with mrc.ZSliceWriter(fname, psz=1.5, buffer=buffer) as writer:
+            for img in imgs:
+                writer.write(img)
+        with open(fname, "rb") as f:
+            return f.read()
+
+    def test_zslicewriter_buffer(self):
+        rng = np.random.RandomState(0)
+        imgs = [rng.randn(24, 24).astype(np.float32) for _ in range(37)]
+        imgs.insert(11, rng.randn(3, 24, 24))
+        ref = self.write_stack(imgs, 1)
+        for buffer in (5, 64):
+            self.assertEqual(ref, self.write_stack(imgs, buffer))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (C) 2018 Daniel Asarnow
+# University of California, San Francisco
+import numpy as np
+import unittest
+from scipy.ndimage import map_coordinates
+from pyem import geom
+from pyem import vop
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+def grid_correct_meshgrid(vol, pfac=2, order=1):
+    n = vol.shape[0]
+    x, y, z = np.meshgrid(*[np.arange(n) - n // 2] * 3, indexing="xy")
+    r = np.sqrt(x**2 + y**2 + z**2) / (n * pfac)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sinc = np.sin(np.pi * r) / (np.pi * r)
+    sinc[r == 0] = 1.
+    if order == 0:
+        return vol / sinc
+    return vol / sinc**2
+
+
+def interpolate_slice_map_coordinates(f3d, rot, pfac=2):
+    nhalf = f3d.shape[0] // 2
+    px, py, pz = np.meshgrid(np.arange(-nhalf, nhalf), np.arange(-nhalf, nhalf), 0)
+    pr = np.sqrt(px ** 2 + py ** 2 + pz ** 2)
+    pr_mask = pr.reshape(-1) < nhalf
+    pcoords = np.vstack([px.reshape(-1), py.reshape(-1), pz.reshape(-1)])[:, pr_mask]
+    mcoords = (rot * pfac).T.dot(pcoords)
+    pvals = map_coordinates(np.real(f3d), mcoords, order=1, mode="grid-wrap") + \
+        1j * map_coordinates(np.imag(f3d), mcoords, order=1, mode="grid-wrap")
+    pslice = np.zeros(pr.shape, dtype=np.complex128)
+    pslice.reshape(-1)[pr_mask] = pvals
+    return pslice
+
+
+class TestVop(unittest.TestCase):
+    def test_grid_correct(self):
+        rng = np.random.RandomState(0)
+        for n in (16, 17):
+            vol = rng.rand(n, n, n).astype(np.float32)
+            for order in (0, 1):
+                cortest = vop.grid_correct(vol, pfac=2, order=order)
+                self.assertTrue(np.all(np.isfinite(cortest)))
+                self.assertTrue(np.allclose(grid_correct_meshgrid(vol, pfac=2, order=order), cortest, rtol=1e-5))
+
+    def test_grid_correct_shape(self):
+        with self.assertRaises(ValueError):
+            vop.grid_correct(np.ones((16, 16, 18), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            vop.grid_correct(np.ones((16, 16), dtype=np.float32))
+
+    def test_interpolate_slice(self):
+        rng = np.random.RandomState(0)
+        f3d = (rng.randn(32, 32, 32) + 1j * rng.randn(32, 32, 32)).astype(np.complex64)
+        for pfac in (1, 2):
+            for _ in range(4):
+                rot = geom.euler2rot(*rng.uniform(-np.pi, np.pi, 3))
+                pslice = vop.interpolate_slice(f3d, rot, pfac=pfac)
+                self.assertTrue(np.allclose(interpolate_slice_map_coordinates(f3d, rot, pfac=pfac), pslice,
+                                            atol=1e-5))
+
+    def test_fewer_unique_than(self):
+        rng = np.random.RandomState(0)
+        vol = rng.rand(32, 32, 32).astype(np.float32)
+        arrs = [vol, vol > 0.5, np.zeros_like(vol), vol.T]
+        arrs += [np.floor(vol * k) / k for k in (10, 99, 100, 101, 1000)]
+        for arr in arrs:
+            for n in (1, 2, 100):
+                self.assertEqual(np.unique(arr).size < n, vop.fewer_unique_than(arr, n))
+            self.assertEqual(np.unique(arr[16]).size < 100, vop.ismask(arr))
+
+    def test_phase_shift(self):
+        sx, sy = np.meshgrid(np.fft.rfftfreq(24), np.fft.fftfreq(24))
+        for xshift, yshift in [(0., 0.), (1.5, -3.25), (-7., 2.)]:
+            pshift = np.exp(-2 * np.pi * 1j * (-xshift * sx + -yshift * sy))
+            self.assertTrue(np.allclose(pshift, vop.phase_shift(sx, sy, xshift, yshift)))
+
+    def test_resample_volume_dtype(self):
+        vol = np.zeros((16, 16, 16), dtype=np.uint8)
+        vol[4:12, 4:12, 4:12] = 1
+        self.assertEqual(np.float32, vop.resample_volume(vol).dtype)
+        self.assertEqual(np.float32, vop.resample_volume(vol, t=[1, 0, 0], order=0).dtype)
+
+    @unittest.skipIf(cupy is None, "CuPy is not installed")
+    def test_resample_volume_gpu(self):
+        rng = np.random.RandomState(0)
+        vol = rng.rand(32, 32, 32).astype(np.float32)
+        r = geom.euler2rot(*rng.uniform(-np.pi, np.pi, 3))
+        t = rng.uniform(-3, 3, 3)
+        for compat in ("mrc2014", "relion"):
+            for order in (0, 1, 3):
+                cpu = vop.resample_volume(vol, r=r, t=t, order=order, compat=compat, gpu=False)
+                gpu = vop.resample_volume(vol, r=r, t=t, order=order, compat=compat, gpu=True)
+                self.assertEqual(cpu.dtype, gpu.dtype)
+                self.assertTrue(np.allclose(cpu, gpu, atol=1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
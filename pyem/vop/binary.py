@@ -21,16 +21,16 @@ from scipy.ndimage import binary_dilation
 from scipy.ndimage import binary_fill_holes
 from scipy.ndimage import distance_transform_edt
 from scipy.ndimage import label
-from scipy.ndimage import labeled_comprehension
 
 
 def binary_sphere(r, le=True):
-    rr = np.linspace(-r, r, 2 * r + 1)
-    x, y, z = np.meshgrid(rr, rr, rr)
+    rr = np.arange(-r, r + 1)
+    rr2 = rr ** 2
+    d2 = rr2[:, None, None] + rr2[None, :, None] + rr2[None, None, :]
     if le:
-        sph = (x ** 2 + y ** 2 + z ** 2) <= r ** 2
+        sph = d2 <= r ** 2
     else:
-        sph = (x ** 2 + y ** 2 + z ** 2) < r ** 2
+        sph = d2 < r ** 2
     return sph
 
 
@@ -38,14 +38,14 @@ def binary_volume_opening(vol, minvol):
     if minvol == 0:
         return vol.copy()
     lb_vol, num_objs = label(vol)
-    lbs = np.arange(1, num_objs + 1)
-    v = labeled_comprehension(lb_vol > 0, lb_vol, lbs, np.sum, np.int, 0)
+    counts = np.bincount(lb_vol.ravel(), minlength=num_objs + 1)
     if minvol < 0:
-        ix = np.isin(lb_vol, lbs[np.argsort(v)[minvol:]])
+        keep = np.zeros(counts.shape, dtype=np.bool_)
+        keep[np.argsort(counts[1:])[minvol:] + 1] = True
     else:
-        ix = np.isin(lb_vol, lbs[v >= minvol])
-    newvol = np.zeros(vol.shape, dtype=np.bool)
-    newvol[ix] = vol[ix]
+        keep = counts >= minvol
+        keep[0] = False
+    newvol = np.logical_and(vol, keep[lb_vol])
     return newvol
 
 
@@ -16,103 +16,140 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
 import numpy as np
 import numpy.ma as ma
+from functools import lru_cache
 from scipy.ndimage import map_coordinates
 from pyfftw.interfaces.numpy_fft import rfftn
+from .vop_numba import fewer_unique_than
 from .vop_numba import fill_ft
+from .vop_numba import grid_correct_nb
+from .vop_numba import _trilerp_complex
 
 
 def ismask(vol):
     """
     Even with a soft edge, a mask will have very few unique values (unless it's already been resampled).
-    The 1D slice below treats just the central XY section for speed. Real maps have ~20,000 unique values here.
+    Only the central section (a contiguous 2D view) is examined for speed. Real maps have ~20,000 unique values here.
     """
-    return np.unique(vol[vol.shape[2] // 2::vol.shape[2]]).size < 100
+    return fewer_unique_than(vol[vol.shape[0] // 2], 100)
 
 
 def resample_volume(vol, r=None, t=None, ori=None, order=3, compat="mrc2014",
-                    indexing="ij", invert=False, scale=None, output_shape=None):
+                    indexing="ij", invert=False, scale=None, output_shape=None, gpu=False):
+    """
+    Resample a volume by rotation, translation and/or scaling using spline interpolation.
+    The resampled volume is always float32, including when no transformation is applied.
+    :param gpu: Interpolate on the GPU using CuPy, falling back to the CPU if the device runs out of memory.
+    """
     if r is None and t is None and scale is None and (output_shape is None or np.array_equal(output_shape, vol.shape)):
-        return vol.copy()
+        return vol.astype(np.float32)
 
     if output_shape is None:
         output_shape = np.array(vol.shape)
     elif np.isscalar(output_shape):
         output_shape = np.array((output_shape, output_shape, output_shape))
 
-    x, y, z = np.meshgrid(*[np.arange(-c, c) for c in output_shape // 2], indexing=indexing)
-    xyz = np.vstack([x.reshape(-1), y.reshape(-1), z.reshape(-1), np.ones(x.size)])
-
-    if ori is not None:
-        xyz -= ori[:, None]
+    # Homogeneous coordinates are filled in place from a sparse grid.
+    grid = np.meshgrid(*[np.arange(-c, c, dtype=np.float32) for c in output_shape // 2],
+                       indexing=indexing, sparse=True)
+    xyz = np.empty((4,) + np.broadcast(*grid).shape, dtype=np.float32)
+    for i, g in enumerate(grid):
+        xyz[i] = g
+    xyz[3] = 1
+    xyz = xyz.reshape(4, -1)
 
     if r is None:
         r = np.eye(3)
 
-    th = np.eye(4)
+    th = np.eye(4, dtype=np.float32)
     if t is None and r.shape[1] == 4:
         t = np.squeeze(r[:, 3])
     elif t is not None:
         th[:3, 3] = t
 
-    rh = np.eye(4)
+    rh = np.eye(4, dtype=np.float32)
     rh[:3, :3] = r[:3, :3].T
 
     if scale is not None:
         rh[:3, :3] /= scale
 
-    center = np.array(vol.shape) // 2
+    oh = np.eye(4, dtype=np.float32)
+    if ori is not None:
+        oh[:3, 3] = -ori
+
+    ch = np.eye(4, dtype=np.float32)
+    ch[:3, 3] = np.array(vol.shape) // 2
 
     if invert:
         th[:3, 3] = -th[:3, 3]
         rh[:3, :3] = rh[:3:, :3].T
-        xyz = rh.dot(th.dot(xyz))[:3, :] + center[:, None]
+        m = ch.dot(rh.dot(th.dot(oh)))
     else:
-        xyz = th.dot(rh.dot(xyz))[:3, :] + center[:, None]
+        m = ch.dot(th.dot(rh.dot(oh)))
 
-    xyz = np.array([arr.reshape(output_shape) for arr in xyz])
+    # Origin, transformation and center are composed so the coordinates are transformed by a single matmul.
+    xyz = m[:3, :].dot(xyz).reshape((3,) + tuple(output_shape))
 
     if "relion" in compat.lower() or "xmipp" in compat.lower():
         xyz = xyz[::-1]
 
-    newvol = map_coordinates(vol, xyz, order=order)
+    if gpu:
+        import cupy
+        from cupyx.scipy.ndimage import map_coordinates as cupy_map_coordinates
+        try:
+            # Relion/Xmipp order reverses xyz, which is copied to be contiguous before the transfer.
+            return cupy.asnumpy(cupy_map_coordinates(cupy.asarray(vol), cupy.asarray(np.ascontiguousarray(xyz)),
+                                                     order=order, output=cupy.float32))
+        except cupy.cuda.memory.OutOfMemoryError:
+            cupy.get_default_memory_pool().free_all_blocks()
+            log = logging.getLogger('root')
+            log.warning("Out of GPU memory, resampling on the CPU")
+    newvol = map_coordinates(vol, xyz, order=order, output=np.float32)
     return newvol
 
 
 def grid_correct(vol, pfac=2, order=1):
-    n = vol.shape[0]
-    nhalf = n // 2
-    x, y, z = np.meshgrid(*[np.arange(-nhalf, nhalf)] * 3, indexing="xy")
-    r = np.sqrt(x**2 + y**2 + z**2, dtype=vol.dtype) / (n * pfac)
-    with np.errstate(divide="ignore", invalid="ignore"):
-        sinc = np.sin(np.pi * r) / (np.pi * r)  # Results in 1 NaN in the center.
-    sinc[nhalf, nhalf, nhalf] = 1.
-    if order == 0:
-       cordata = vol / sinc
-    elif order == 1:
-       cordata = vol / sinc**2
-    else:
+    if order not in (0, 1):
         raise NotImplementedError("Only nearest-neighbor and trilinear grid corrections are available")
+    if vol.ndim != 3 or not vol.shape[0] == vol.shape[1] == vol.shape[2]:
+        raise ValueError("Grid correction requires a cubic volume")
+    cordata = np.empty(vol.shape, dtype=np.float32)
+    grid_correct_nb(vol, cordata, pfac=pfac, order=order)
     return cordata
 
 
+@lru_cache(maxsize=8)
+def _slice_grid(phalf, nhalf):
+    """
+    Central section coordinates within the Nyquist radius, which depend only on the slice and volume sizes.
+    Returned arrays are cached and shared between calls, so they are marked read-only.
+    """
+    px, py, pz = np.meshgrid(np.arange(-phalf, phalf), np.arange(-phalf, phalf), 0)
+    pr = np.sqrt(px ** 2 + py ** 2 + pz ** 2)
+    pr_mask = pr.reshape(-1) < nhalf
+    pcoords = np.vstack([px.reshape(-1), py.reshape(-1), pz.reshape(-1)])
+    pcoords = np.ascontiguousarray(pcoords[:, pr_mask], dtype=np.float32)
+    pcoords.flags.writeable = False
+    pr_mask.flags.writeable = False
+    return pcoords, pr_mask, pr.shape
+
+
 def interpolate_slice(f3d, rot, pfac=2, size=None):
-    nhalf = f3d.shape[0] / 2
+    nhalf = f3d.shape[0] // 2
     if size is None:
         phalf = nhalf
     else:
-        phalf = size / 2
-    qot = rot * pfac  # Scaling!
-    px, py, pz = np.meshgrid(np.arange(-phalf, phalf), np.arange(-phalf, phalf), 0)
-    pr = np.sqrt(px ** 2 + py ** 2 + pz ** 2)
-    pcoords = np.vstack([px.reshape(-1), py.reshape(-1), pz.reshape(-1)])
+        phalf = int(size) // 2
+    qot = (rot * pfac).astype(np.float32)  # Scaling!
+    pcoords, pr_mask, pr_shape = _slice_grid(phalf, nhalf)
     mcoords = qot.T.dot(pcoords)
-    mcoords = mcoords[:, pr.reshape(-1) < nhalf]
-    pvals = map_coordinates(np.real(f3d), mcoords, order=1, mode="wrap") + \
-             1j * map_coordinates(np.imag(f3d), mcoords, order=1, mode="wrap")
-    pslice = np.zeros(pr.shape, dtype=np.complex)
-    pslice[pr < nhalf] = pvals
+    pslice = np.zeros(pr_shape, dtype=np.result_type(f3d.dtype, np.complex64))
+    pvals_re = np.empty(mcoords.shape[1], dtype=pslice.real.dtype)
+    pvals_im = np.empty(mcoords.shape[1], dtype=pslice.real.dtype)
+    _trilerp_complex(f3d.real, f3d.imag, mcoords, pvals_re, pvals_im)
+    pslice.reshape(-1)[pr_mask] = pvals_re + 1j * pvals_im
     return pslice
 
 
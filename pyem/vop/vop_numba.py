@@ -34,6 +34,91 @@ def fill_ft(ft, ftc, rmax, normfft=1):
                     ftc[kp + ftc.shape[0]//2, ip + ftc.shape[1]//2, jp] = ft[k, i, j] * normfft
 
 
+@numba.jit(cache=True, nopython=True, nogil=True)
+def fewer_unique_than(arr, n):
+    """
+    True if arr has fewer than n distinct values. Returns as soon as n distinct values are seen.
+    """
+    seen = set()
+    for x in arr.flat:
+        seen.add(x)
+        if len(seen) >= n:
+            return False
+    return True
+
+
+@numba.jit(cache=True, nopython=True, nogil=True, parallel=True, fastmath=True)
+def grid_correct_nb(vol, out, pfac=2, order=1):
+    n = vol.shape[0]
+    rng = ((np.arange(n) - n // 2) / (n * pfac)).astype(np.float32)
+    rng2 = rng ** 2
+    pi = np.float32(np.pi)
+    for i in numba.prange(n):
+        for j in range(n):
+            for k in range(n):
+                r = np.sqrt(rng2[i] + rng2[j] + rng2[k])
+                if r == 0:
+                    sinc = np.float32(1.)
+                else:
+                    sinc = np.sin(pi * r) / (pi * r)
+                if order == 0:
+                    out[i, j, k] = vol[i, j, k] / sinc
+                else:
+                    out[i, j, k] = vol[i, j, k] / sinc**2
+    return out
+
+
+@numba.jit(cache=True, nopython=True, nogil=True, parallel=True, fastmath=True)
+def _trilerp_complex(f3d_re, f3d_im, coords_xyz, out_re, out_im):
+    """
+    Trilinear interpolation of the real and imaginary parts of a volume in a single pass,
+    with periodic boundaries. Coordinates are given as (3, N) for axes 0, 1, 2.
+    """
+    n0, n1, n2 = f3d_re.shape
+    for n in numba.prange(coords_xyz.shape[1]):
+        x = coords_xyz[0, n]
+        y = coords_xyz[1, n]
+        z = coords_xyz[2, n]
+        fx = np.floor(x)
+        fy = np.floor(y)
+        fz = np.floor(z)
+        ax = x - fx
+        ay = y - fy
+        az = z - fz
+        x0 = np.int64(fx) % n0
+        y0 = np.int64(fy) % n1
+        z0 = np.int64(fz) % n2
+        x1 = (x0 + 1) % n0
+        y1 = (y0 + 1) % n1
+        z1 = (z0 + 1) % n2
+        w000 = (1 - ax) * (1 - ay) * (1 - az)
+        w001 = (1 - ax) * (1 - ay) * az
+        w010 = (1 - ax) * ay * (1 - az)
+        w011 = (1 - ax) * ay * az
+        w100 = ax * (1 - ay) * (1 - az)
+        w101 = ax * (1 - ay) * az
+        w110 = ax * ay * (1 - az)
+        w111 = ax * ay * az
+        out_re[n] = w000 * f3d_re[x0, y0, z0] + w001 * f3d_re[x0, y0, z1] + \
+            w010 * f3d_re[x0, y1, z0] + w011 * f3d_re[x0, y1, z1] + \
+            w100 * f3d_re[x1, y0, z0] + w101 * f3d_re[x1, y0, z1] + \
+            w110 * f3d_re[x1, y1, z0] + w111 * f3d_re[x1, y1, z1]
+        out_im[n] = w000 * f3d_im[x0, y0, z0] + w001 * f3d_im[x0, y0, z1] + \
+            w010 * f3d_im[x0, y1, z0] + w011 * f3d_im[x0, y1, z1] + \
+            w100 * f3d_im[x1, y0, z0] + w101 * f3d_im[x1, y0, z1] + \
+            w110 * f3d_im[x1, y1, z0] + w111 * f3d_im[x1, y1, z1]
+
+
+@numba.jit(cache=True, nopython=True, nogil=True)
+def phase_shift(sx, sy, xshift, yshift):
+    """
+    Fourier phase shift for a real space translation of (xshift, yshift) pixels on the frequency grid sx, sy.
+    The shift is separable, so only the frequency axes are exponentiated and combined by an outer product.
+    """
+    return np.outer(np.exp(2 * np.pi * 1j * yshift * sy[:, 0]),
+                    np.exp(2 * np.pi * 1j * xshift * sx[0, :]))
+
+
 @numba.jit(cache=False, nopython=True, nogil=True)
 def interpolate_slice_numba(f3d, rot, pfac=2, size=None):
     linterp = lambda a, l, h: l + (h - l) * a
@@ -83,12 +83,11 @@ def main(args):
     idx = np.where(height >= 0.01)[0]
     width = args.width_scale * np.pi * r * angular_sampling / 360
     bild = np.hstack((base1, base2, np.ones((base1.shape[0], 1)) * width))
-    fmt_color = ".color %f 0 %f\n"
-    fmt_cyl = ".cylinder %f %f %f %f %f %f %f\n"
+    fmt = ".color %f 0 %f\n" \
+          ".cylinder %f %f %f %f %f %f %f\n"
+    rows = np.column_stack((color_scale, 1 - color_scale, bild))[idx].tolist()
     with open(args.output, "w") as f:
-        for i in idx:
-            f.write(fmt_color % (color_scale[i], 1 - color_scale[i]))
-            f.write(fmt_cyl % tuple(bild[i]))
+        f.write("".join([fmt % tuple(row) for row in rows]))
     return 0
 
 